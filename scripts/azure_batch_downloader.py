@@ -7,11 +7,15 @@ Supports the videos/ruijian-research/raw and videos/ruijian-research/celeba-hq s
 
 import os
 import sys
-import json
+import argparse
 from pathlib import Path
 from datetime import datetime
-from azure.storage.blob import BlobServiceClient
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 from azure.core.exceptions import ResourceNotFoundError, HttpResponseError
+from azure_common import BLOB_MAX_CONCURRENCY, create_download_client, load_env_conn_str, write_stream_to_file
+
+BATCH_MAPPING_DIR = "/root/autodl-tmp/VLM_forgery_detection/data/batch"
 
 class AzureBatchDownloader:
     def __init__(self, connection_string=None):
@@ -25,20 +29,18 @@ class AzureBatchDownloader:
         self.conn_str = connection_string or os.getenv("AZURE_STORAGE_CONNECTION_STRING")
         if not self.conn_str:
             # Load from .env file
-            env_file_path = "/root/autodl-tmp/azure_sync/credentials/.env"
-            if os.path.exists(env_file_path):
-                with open(env_file_path, 'r') as f:
-                    for line in f:
-                        if line.strip() and line.startswith('AZURE_STORAGE_CONNECTION_STRING'):
-                            self.conn_str = line.split('=', 1)[1].strip().strip('"').strip("'")
-                            break
+            self.conn_str = load_env_conn_str()
             if not self.conn_str:
                 raise ValueError("Azure Storage connection string not found. Please set AZURE_STORAGE_CONNECTION_STRING environment variable or create credentials/.env file")
         
-        self.blob_service_client = BlobServiceClient.from_connection_string(self.conn_str)
+        self.blob_service_client = create_download_client(self.conn_str)
         self.container_name = "videos"
         self.raw_video_path = "ruijian-research/raw"
         self.celeba_path = "ruijian-research/celeba-hq"
+        self.container_client = self.blob_service_client.get_container_client(self.container_name)
+        
+        # Blob path -> size, filled by the first HEAD or download of each blob in this process
+        self._size_cache = {}
     
     def download_file(self, blob_path, local_path):
         """
@@ -52,21 +54,34 @@ class AzureBatchDownloader:
             bool: True if successful, False otherwise
         """
         try:
-            blob_client = self.blob_service_client.get_blob_client(
-                container=self.container_name,
-                blob=blob_path
-            )
+            # A blob already checked or downloaded in this process needs no further Azure call
+            try:
+                local_size = os.stat(local_path).st_size
+            except FileNotFoundError:
+                local_size = None
+            
+            if local_size is not None and local_size == self._size_cache.get(blob_path):
+                print(f"⏭️ Skipping {blob_path} - already exists ({local_size:,} bytes)")
+                return True
+            
+            blob_client = self.container_client.get_blob_client(blob_path)
+            
+            # First check of this blob: one HEAD is still far cheaper than a full re-download
+            if local_size is not None and blob_path not in self._size_cache:
+                self._size_cache[blob_path] = blob_client.get_blob_properties().size
+                if local_size == self._size_cache[blob_path]:
+                    print(f"⏭️ Skipping {blob_path} - already exists ({local_size:,} bytes)")
+                    return True
             
             # Create directory if it doesn't exist
             os.makedirs(os.path.dirname(local_path), exist_ok=True)
             
             print(f"📥 Downloading {blob_path} -> {local_path}")
             
-            with open(local_path, "wb") as download_file:
-                download_file.write(blob_client.download_blob().readall())
-            
-            # Get file size for reporting
-            file_size = os.path.getsize(local_path)
+            # Stream chunks to disk as they arrive rather than reading the whole blob into memory
+            download_stream = blob_client.download_blob(max_concurrency=BLOB_MAX_CONCURRENCY)
+            file_size = write_stream_to_file(download_stream, local_path)
+            self._size_cache[blob_path] = file_size
             print(f"   ✅ Downloaded {file_size:,} bytes")
             
             return True
@@ -103,11 +118,12 @@ class AzureBatchDownloader:
         
         print(f"🎯 Downloading pair: {video_name} + {image_name}")
         
-        # Download video
-        video_success = self.download_file(video_blob_path, str(video_local_path))
-        
-        # Download image
-        image_success = self.download_file(image_blob_path, str(image_local_path))
+        # Download video and image concurrently so the small image hides behind the video
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            video_future = executor.submit(self.download_file, video_blob_path, str(video_local_path))
+            image_future = executor.submit(self.download_file, image_blob_path, str(image_local_path))
+            video_success = video_future.result()
+            image_success = image_future.result()
         
         return video_success, image_success, str(video_local_path), str(image_local_path)
     
@@ -124,8 +140,7 @@ class AzureBatchDownloader:
         """
         print(f"📖 Loading batch mapping: {batch_mapping_file}")
         
-        with open(batch_mapping_file, 'r') as f:
-            batch_data = json.load(f)
+        batch_data = orjson.loads(Path(batch_mapping_file).read_bytes())
         
         mapping = batch_data['mapping']
         if not mapping:
@@ -171,49 +186,67 @@ class AzureBatchDownloader:
         return report
 
 def main():
-    """Main function to download first pair from batch_001"""
+    """Main function to download the first pair from one or more batches"""
+    parser = argparse.ArgumentParser(description="Download the first video-image pair from batch mapping files")
+    parser.add_argument("--batches", nargs="+", default=["001"], help="Batch IDs to download from (e.g., 001 002 003)")
+    parser.add_argument("--batch-dir", default=BATCH_MAPPING_DIR, help="Directory containing batch_XXX/video_image_mapping.json")
+    parser.add_argument("--output", default="/root/autodl-tmp/VLM_forgery_detection/data/batch_data", help="Output directory")
+    args = parser.parse_args()
+    
     print("🚀 Azure Batch Downloader")
     print("=" * 50)
     
-    # Paths
-    batch_file = "/root/autodl-tmp/VLM_forgery_detection/data/batch/batch_001/video_image_mapping.json"
-    output_dir = "/root/autodl-tmp/VLM_forgery_detection/data/batch_data"
+    output_dir = args.output
+    failed_batches = []
     
     try:
-        # Initialize downloader
+        # Initialize downloader once; its client and connection pool serve every batch
         downloader = AzureBatchDownloader()
-        
-        # Download first pair from batch_001
-        report = downloader.download_first_pair_from_batch(batch_file, output_dir)
-        
-        # Save download report
-        report_file = Path(output_dir) / "download_report.json"
-        with open(report_file, 'w') as f:
-            json.dump(report, f, indent=2)
-        
-        # Print summary
-        print(f"\n📊 Download Summary:")
-        print("=" * 30)
-        print(f"Video: {'✅ SUCCESS' if report['download_results']['video_success'] else '❌ FAILED'}")
-        print(f"Image: {'✅ SUCCESS' if report['download_results']['image_success'] else '❌ FAILED'}")
-        print(f"Overall: {'✅ COMPLETE' if report['download_results']['both_successful'] else '⚠️ PARTIAL'}")
-        
-        if report['download_results']['both_successful']:
-            print(f"\n📁 Files saved to: {output_dir}")
-            print(f"   🎬 Video: {report['pair_info']['video_name']}")
-            print(f"   🖼️ Image: {report['pair_info']['image_name']}")
-        
-        print(f"\n📋 Report saved: {report_file}")
-        
-    except FileNotFoundError as e:
-        print(f"❌ Batch file not found: {e}")
-        sys.exit(1)
-        
     except Exception as e:
         print(f"💥 Unexpected error: {e}")
         import traceback
         traceback.print_exc()
         sys.exit(1)
+    
+    for batch_id in args.batches:
+        batch_file = os.path.join(args.batch_dir, f"batch_{batch_id}", "video_image_mapping.json")
+        
+        try:
+            # Download first pair from this batch
+            report = downloader.download_first_pair_from_batch(batch_file, output_dir)
+            
+            # Save download report (one per batch when several are requested)
+            report_name = "download_report.json" if len(args.batches) == 1 else f"download_report_batch_{batch_id}.json"
+            report_file = Path(output_dir) / report_name
+            report_file.write_bytes(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+            
+            # Print summary
+            print(f"\n📊 Download Summary (batch_{batch_id}):")
+            print("=" * 30)
+            print(f"Video: {'✅ SUCCESS' if report['download_results']['video_success'] else '❌ FAILED'}")
+            print(f"Image: {'✅ SUCCESS' if report['download_results']['image_success'] else '❌ FAILED'}")
+            print(f"Overall: {'✅ COMPLETE' if report['download_results']['both_successful'] else '⚠️ PARTIAL'}")
+            
+            if report['download_results']['both_successful']:
+                print(f"\n📁 Files saved to: {output_dir}")
+                print(f"   🎬 Video: {report['pair_info']['video_name']}")
+                print(f"   🖼️ Image: {report['pair_info']['image_name']}")
+            
+            print(f"\n📋 Report saved: {report_file}")
+            
+        except FileNotFoundError as e:
+            print(f"❌ Batch file not found: {e}")
+            failed_batches.append(batch_id)
+            
+        except Exception as e:
+            print(f"💥 Unexpected error in batch_{batch_id}: {e}")
+            import traceback
+            traceback.print_exc()
+            failed_batches.append(batch_id)
+    
+    if failed_batches:
+        print(f"\n⚠️ Failed batches: {', '.join(failed_batches)}")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
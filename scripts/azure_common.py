@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Shared Azure download helpers
+Client setup, credential loading and blob-to-disk streaming used by
+azure_download.py and azure_batch_downloader.py
+"""
+
+import os
+import functools
+from pathlib import Path
+from typing import Optional
+import requests
+from requests.adapters import HTTPAdapter
+from azure.storage.blob import BlobServiceClient
+from azure.core.pipeline.transport import RequestsTransport
+
+ENV_FILE_PATH = "/root/autodl-tmp/azure_sync/credentials/.env"
+
+# HTTP connection pool size; must stay above the worker count or urllib3
+# discards connections and every extra request pays a fresh TLS handshake
+MAX_CONNECTIONS = 64
+CONNECTION_DATA_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Fetch images and small videos in one GET; split large videos into 16 MiB ranges
+MAX_SINGLE_GET_SIZE = 64 * 1024 * 1024
+MAX_CHUNK_GET_SIZE = 16 * 1024 * 1024
+
+# Parallel ranged GETs per blob (only used for blobs split into chunks)
+BLOB_MAX_CONCURRENCY = 8
+
+
+def build_transport(pool_size: int = MAX_CONNECTIONS) -> RequestsTransport:
+    """Create an HTTP transport whose connection pool fits concurrent downloads"""
+    session = requests.Session()
+    # pool_block makes bursts wait for a warm keep-alive connection rather than
+    # opening throwaway ones, so small image GETs never pay an extra TLS handshake
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return RequestsTransport(session=session)
+
+
+def create_download_client(connection_string: str, pool_size: int = MAX_CONNECTIONS) -> BlobServiceClient:
+    """Create a BlobServiceClient tuned for downloads (pooled transport, large GETs)"""
+    return BlobServiceClient.from_connection_string(
+        connection_string,
+        transport=build_transport(max(MAX_CONNECTIONS, pool_size)),
+        connection_data_block_size=CONNECTION_DATA_BLOCK_SIZE,
+        max_single_get_size=MAX_SINGLE_GET_SIZE,
+        max_chunk_get_size=MAX_CHUNK_GET_SIZE
+    )
+
+
+def write_stream_to_file(download_stream, local_path: str) -> int:
+    """Write a blob download stream into a preallocated, unbuffered file"""
+    # Preallocation makes the size final before any data lands, so fill a .part file
+    # and only rename it into place once complete; a killed run can't leave a
+    # full-size file of zeros that passes the size check on the next run
+    part_path = f"{local_path}.part"
+    fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        with os.fdopen(fd, 'wb', buffering=0) as f:
+            if download_stream.size and hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(fd, 0, download_stream.size)
+                except OSError:
+                    pass  # Filesystem doesn't support preallocation
+            written = download_stream.readinto(f)
+        os.replace(part_path, local_path)
+        return written
+    except BaseException:
+        os.remove(part_path)
+        raise
+
+
+@functools.lru_cache(maxsize=1)
+def load_env_conn_str(env_path: str = ENV_FILE_PATH) -> Optional[str]:
+    """Read the connection string from the credentials .env file (parsed once per process)"""
+    env_file = Path(env_path)
+    if not env_file.exists():
+        return None
+    
+    pairs = (line.split('=', 1) for line in env_file.read_text().splitlines() if '=' in line)
+    env = {key.strip(): value for key, value in pairs}
+    connection_string = env.get('AZURE_STORAGE_CONNECTION_STRING')
+    if connection_string is None:
+        return None
+    return connection_string.strip().strip('"').strip("'")
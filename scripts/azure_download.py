@@ -4,38 +4,57 @@ Azure Batch Download Script
 Downloads video-image pairs for any batch from Azure Blob Storage
 """
 
-import json
+import atexit
 import logging
 import os
+import queue
 import sys
 import argparse
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Dict, List, Tuple
-from azure.storage.blob import BlobServiceClient
+import orjson
 from azure.core.exceptions import ResourceNotFoundError
+from azure_common import BLOB_MAX_CONCURRENCY, create_download_client, load_env_conn_str, write_stream_to_file
 from datetime import datetime
 import time
 
-# Configure logging
+# Configure logging; file writes go through a queue so download threads never block on disk
+_log_queue = queue.Queue(-1)
+_file_handler = logging.FileHandler('/root/autodl-tmp/azure_sync/logs/download.log')
+_file_handler.setFormatter(logging.Formatter('%(message)s'))  # QueueHandler already applied the format
+_log_listener = QueueListener(_log_queue, _file_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
         logging.StreamHandler(),
-        logging.FileHandler('/root/autodl-tmp/azure_sync/logs/download.log')
+        QueueHandler(_log_queue)
     ]
 )
 logger = logging.getLogger(__name__)
 
+# Downloads are network-bound, so run well above the core count
+DEFAULT_MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
 
 class AzureBatchDownloader:
     """Download video-image pairs for any batch from Azure Blob Storage"""
     
-    def __init__(self, connection_string: str):
-        self.blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+    def __init__(self, connection_string: str, max_workers: int = DEFAULT_MAX_WORKERS):
+        self.blob_service_client = create_download_client(connection_string, max_workers)
+        self.max_workers = max_workers
         self.container = "videos"
         self.video_source_path = "ruijian-research/raw"
         self.image_source_path = "ruijian-research/celeba-hq"
+        self.container_client = self.blob_service_client.get_container_client(self.container)
+        
+        # Blob name -> size, seeded by one listing per batch instead of a HEAD per file
+        self._size_cache: Dict[str, int] = {}
     
     def load_batch_config(self, batch_id: str) -> Dict:
         """Load batch configuration from JSON file"""
@@ -44,8 +63,7 @@ class AzureBatchDownloader:
         if not batch_config_path.exists():
             raise FileNotFoundError(f"Batch config not found: {batch_config_path}")
         
-        with open(batch_config_path, 'r') as f:
-            batch_data = json.load(f)
+        batch_data = orjson.loads(batch_config_path.read_bytes())
         
         if 'mapping' not in batch_data:
             raise ValueError(f"Invalid batch file format: missing 'mapping' key")
@@ -82,45 +100,83 @@ class AzureBatchDownloader:
         
         logger.info(f"🚀 Downloading {len(video_pairs)} video-image pairs for batch_{batch_id}")
         
+        sizes_prefetched = False
+        try:
+            self._prefetch_blob_sizes()
+            sizes_prefetched = True
+        except Exception as e:
+            logger.warning(f"⚠️ Could not prefetch blob sizes, falling back to per-file checks: {e}")
+        
+        # Precompute string prefixes once; the per-pair loops below only concatenate
+        video_prefix = self.video_source_path + '/'
+        image_prefix = self.image_source_path + '/'
+        output_prefix = str(output_path) + '/'
+        
+        # Drop pairs whose blobs are absent from the listing instead of paying a 404 per file
+        total_requested = len(video_pairs)
+        missing_pairs = []
+        if sizes_prefetched:
+            available_pairs = []
+            for video_file, image_file in video_pairs:
+                if video_prefix + video_file in self._size_cache and image_prefix + image_file in self._size_cache:
+                    available_pairs.append((video_file, image_file))
+                else:
+                    missing_pairs.append((video_file, image_file))
+                    logger.error(f"❌ Not found in Azure, skipping pair: {video_file} + {image_file}")
+            
+            if missing_pairs:
+                logger.warning(f"⚠️ Skipping {len(missing_pairs)} pairs with missing blobs")
+            video_pairs = available_pairs
+        
         # Download statistics
         downloaded_count = 0
-        failed_count = 0
+        failed_count = len(missing_pairs)
         total_size = 0
         start_time = time.time()
         
-        for i, (video_file, image_file) in enumerate(video_pairs):
+        # Flatten pairs into independent blob downloads so video and image
+        # transfers overlap across the whole batch
+        jobs = []
+        for video_file, image_file in video_pairs:
             video_id = video_file.replace('.0_processed.mp4', '')
             
-            try:
-                logger.info(f"📥 [{i+1}/{len(video_pairs)}] Processing {video_id}")
-                
-                # Create video-specific directory
-                video_output_dir = output_path / video_id
-                video_output_dir.mkdir(exist_ok=True)
-                
-                # Download video
-                video_downloaded, video_size = self._download_file(
-                    f"{self.video_source_path}/{video_file}",
-                    video_output_dir / video_file
-                )
+            # Create video-specific directory
+            video_output_dir = output_prefix + video_id
+            os.makedirs(video_output_dir, exist_ok=True)
+            
+            jobs.append((video_prefix + video_file, video_output_dir + '/' + video_file, video_id, 'video'))
+            jobs.append((image_prefix + image_file, video_output_dir + '/' + image_file, video_id, 'image'))
+        
+        # Per-pair results: video_id -> {kind: (success, size)}
+        pair_results: Dict[str, Dict[str, Tuple[bool, int]]] = {}
+        
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self._download_file, blob_path, local_path): (video_id, kind)
+                for blob_path, local_path, video_id, kind in jobs
+            }
+            
+            for future in as_completed(futures):
+                video_id, kind = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"💥 Error downloading {kind} for {video_id}: {e}")
+                    result = (False, 0)
                 
-                # Download reference image
-                image_downloaded, image_size = self._download_file(
-                    f"{self.image_source_path}/{image_file}",
-                    video_output_dir / image_file
-                )
+                results = pair_results.setdefault(video_id, {})
+                results[kind] = result
+                if len(results) < 2:
+                    continue
                 
+                (video_downloaded, video_size), (image_downloaded, image_size) = results['video'], results['image']
                 if video_downloaded and image_downloaded:
                     downloaded_count += 1
                     total_size += video_size + image_size
-                    logger.info(f"✅ Downloaded {video_id} ({video_size + image_size:,} bytes)")
+                    logger.info(f"✅ [{downloaded_count + failed_count}/{total_requested}] Downloaded {video_id} ({video_size + image_size:,} bytes)")
                 else:
                     failed_count += 1
                     logger.error(f"❌ Failed to download {video_id}")
-                
-            except Exception as e:
-                failed_count += 1
-                logger.error(f"💥 Error downloading {video_id}: {e}")
         
         # Summary statistics
         elapsed_time = time.time() - start_time
@@ -128,9 +184,10 @@ class AzureBatchDownloader:
         
         stats = {
             'batch_id': batch_id,
-            'total_requested': len(video_pairs),
+            'total_requested': total_requested,
             'downloaded': downloaded_count,
             'failed': failed_count,
+            'missing_in_azure': len(missing_pairs),
             'success_rate': success_rate,
             'total_size_mb': total_size / (1024 * 1024),
             'elapsed_time_sec': elapsed_time,
@@ -140,7 +197,7 @@ class AzureBatchDownloader:
         logger.info(f"""
 🎯 Download Summary for batch_{batch_id}:
    ✅ Successfully downloaded: {downloaded_count}
-   ❌ Failed: {failed_count}  
+   ❌ Failed: {failed_count} ({len(missing_pairs)} missing in Azure)
    📊 Success rate: {success_rate:.1f}%
    💾 Total size: {total_size / (1024 * 1024):.1f} MB
    ⏱️ Time taken: {elapsed_time:.1f} seconds
@@ -149,37 +206,40 @@ class AzureBatchDownloader:
         
         # Save download report
         report_path = output_path / "download_report.json"
-        with open(report_path, 'w') as f:
-            json.dump(stats, f, indent=2)
+        report_path.write_bytes(orjson.dumps(stats, option=orjson.OPT_INDENT_2))
         
         return stats
     
-    def _download_file(self, blob_path: str, local_path: Path) -> Tuple[bool, int]:
+    def _prefetch_blob_sizes(self) -> None:
+        """List the video and image prefixes once and cache every blob size"""
+        for prefix in (self.video_source_path, self.image_source_path):
+            for blob in self.container_client.list_blobs(name_starts_with=f"{prefix}/"):
+                self._size_cache[blob.name] = blob.size
+        
+        logger.info(f"📋 Cached sizes for {len(self._size_cache)} blobs")
+    
+    def _download_file(self, blob_path: str, local_path: str) -> Tuple[bool, int]:
         """Download a single file from Azure"""
         try:
-            blob_client = self.blob_service_client.get_blob_client(
-                container=self.container,
-                blob=blob_path
-            )
+            blob_client = self.container_client.get_blob_client(blob_path)
             
             # Check if file already exists and is complete
-            if local_path.exists():
+            if os.path.exists(local_path):
                 try:
-                    # Get blob size to compare
-                    blob_properties = blob_client.get_blob_properties()
-                    local_size = local_path.stat().st_size
-                    if local_size == blob_properties.size:
+                    # Get blob size to compare, falling back to a HEAD on cache miss
+                    expected_size = self._size_cache.get(blob_path)
+                    if expected_size is None:
+                        expected_size = blob_client.get_blob_properties().size
+                    local_size = os.stat(local_path).st_size
+                    if local_size == expected_size:
                         logger.debug(f"⏭️ Skipping {blob_path} - already exists ({local_size:,} bytes)")
                         return True, local_size
                 except Exception:
                     pass  # Download anyway if we can't verify
             
-            # Download file
-            with open(local_path, 'wb') as f:
-                download_stream = blob_client.download_blob()
-                data = download_stream.readall()
-                f.write(data)
-                file_size = len(data)
+            # Stream straight to disk instead of buffering the whole blob in memory
+            download_stream = blob_client.download_blob(max_concurrency=BLOB_MAX_CONCURRENCY)
+            file_size = write_stream_to_file(download_stream, local_path)
             
             logger.debug(f"✅ Downloaded {blob_path} ({file_size:,} bytes)")
             return True, file_size
@@ -196,12 +256,9 @@ class AzureBatchDownloader:
         batch_configs_dir = Path("/root/autodl-tmp/azure_sync/batch_configs")
         batches = []
         
-        for batch_dir in batch_configs_dir.glob("batch_*"):
-            if batch_dir.is_dir():
-                batch_id = batch_dir.name.replace("batch_", "")
-                mapping_file = batch_dir / "video_image_mapping.json"
-                if mapping_file.exists():
-                    batches.append(batch_id)
+        # Matching the mapping file directly only yields batches that have one
+        for mapping_file in batch_configs_dir.glob("batch_*/video_image_mapping.json"):
+            batches.append(mapping_file.parent.name.replace("batch_", "", 1))
         
         return sorted(batches)
 
@@ -217,6 +274,7 @@ def main():
     # Download control
     parser.add_argument("--limit", type=int, help="Limit number of video pairs to download")
     parser.add_argument("--start-from", help="Video ID to start downloading from")
+    parser.add_argument("--max-workers", type=int, default=DEFAULT_MAX_WORKERS, help="Number of concurrent blob downloads")
     
     # Connection
     parser.add_argument("--connection-string", help="Azure storage connection string (or use .env)")
@@ -227,20 +285,17 @@ def main():
     # Load connection string
     connection_string = args.connection_string
     if not connection_string:
-        env_file = Path("/root/autodl-tmp/azure_sync/credentials/.env")
-        if env_file.exists():
-            with open(env_file, 'r') as f:
-                for line in f:
-                    if line.strip() and line.startswith('AZURE_STORAGE_CONNECTION_STRING'):
-                        connection_string = line.split('=', 1)[1].strip().strip('"').strip("'")
-                        break
+        connection_string = load_env_conn_str()
     
     if not connection_string:
         logger.error("❌ Azure connection string not found. Use --connection-string or set up .env file")
         sys.exit(1)
     
     try:
-        downloader = AzureBatchDownloader(connection_string)
+        downloader = AzureBatchDownloader(
+            connection_string,
+            max_workers=args.max_workers
+        )
         
         # List available batches
         if args.list_batches:
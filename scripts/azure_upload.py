@@ -5,14 +5,26 @@ Uploads processing results for any batch to Azure Blob Storage
 """
 
 import json
+import base64
+import bisect
+import hashlib
 import logging
 import os
+import re
 import sys
 import argparse
+import sqlite3
+import tarfile
+import tempfile
+import threading
 from pathlib import Path
-from typing import Dict, List, Tuple
-from azure.storage.blob import BlobServiceClient
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+import requests
+from requests.adapters import HTTPAdapter
+from azure.storage.blob import BlobBlock, BlobServiceClient, ContentSettings
 from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
 from datetime import datetime
 import time
 
@@ -27,14 +39,210 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Videos uploaded in parallel; uploads are network-bound, so this can exceed the core count
+DEFAULT_MAX_CONCURRENCY = 8
+
+# Files uploaded in parallel across all videos
+DEFAULT_MAX_FILE_CONCURRENCY = 16
+
+# Files under this size are uploaded from a single in-memory read; larger ones stream from the file
+STREAM_THRESHOLD = 4 * 1024 * 1024
+
+# Files at least this large are hashed on the hash pool ahead of their upload;
+# at most HASH_PREFETCH_LIMIT hashes are queued, anything beyond is hashed inline
+HASH_OFFLOAD_THRESHOLD = 4 * 1024 * 1024
+HASH_PREFETCH_LIMIT = 2 * (os.cpu_count() or 1)
+
+# Small-file bundling: files under BUNDLE_MAX_FILE_SIZE become blocks of one blob
+# once a video has at least BUNDLE_MIN_FILES of them
+BUNDLE_MAX_FILE_SIZE = 1024 * 1024
+BUNDLE_MIN_FILES = 8
+BUNDLE_BLOB_NAME = "_bundle.bin"
+BUNDLE_INDEX_NAME = "_bundle_index.json"
+
+# Log an INFO progress line every N completed videos
+PROGRESS_LOG_INTERVAL = 50
+
+# Adaptive upload concurrency: start here, halve on throttling, +1 per clean interval
+INITIAL_FILE_CONCURRENCY = 8
+CONCURRENCY_INCREASE_INTERVAL = 60.0
+THROTTLE_STATUS_CODES = (500, 503)
+THROTTLE_COOLDOWN = 5.0
+
+# Parallel block uploads within a single large blob
+BLOB_MAX_CONCURRENCY = 8
+
+# HTTP connection pool size shared by every upload thread (urllib3 defaults to 10)
+MAX_CONNECTIONS = 64
+
+# AZURE_STORAGE_CONNECTION_STRING=... line in the credentials .env file
+_CONN_RE = re.compile(r'^AZURE_STORAGE_CONNECTION_STRING[ \t]*=[ \t]*["\']?([^"\'\n]+)', re.M)
+
+# In-memory limit for a video's tar archive before it spills to a temp file
+ARCHIVE_SPOOL_SIZE = 64 * 1024 * 1024
+
+# Sidecar in the results directory caching local MD5s keyed by (path, mtime, size)
+MD5_CACHE_FILE = ".azure_md5_cache.json"
+
+# Fully uploaded videos in this results directory, one "batch_id/video_id<TAB>fingerprint"
+# per line; skipped on later runs while their files are unchanged
+COMPLETED_FILE = ".azure_completed"
+
+
+def _build_transport(pool_size: int = MAX_CONNECTIONS) -> RequestsTransport:
+    """Create an HTTP transport whose connection pool fits concurrent uploads"""
+    session = requests.Session()
+    # Retries are left to the SDK's retry policy; pool_block reuses warm connections
+    # instead of opening throwaway ones when threads outnumber the pool
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return RequestsTransport(session=session)
+
+
+def _md5_file(path: str) -> bytes:
+    """Compute the MD5 digest of a file in 1 MiB chunks"""
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.digest()
+
+
+def _walk_files(root: str) -> Iterator[Tuple[os.DirEntry, str]]:
+    """Yield (entry, relative_path) for every file under root using os.scandir"""
+    stack = [(root, '')]
+    while stack:
+        directory, prefix = stack.pop()
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, prefix + entry.name + '/'))
+                elif entry.is_file():
+                    yield entry, prefix + entry.name
+
+
+def _fingerprint(stats: Iterable[os.stat_result]) -> str:
+    """Summarize a video's files as "count:total_size:max_mtime_ns"; any add, remove or edit changes it"""
+    count = total_size = max_mtime = 0
+    for stat_result in stats:
+        count += 1
+        total_size += stat_result.st_size
+        max_mtime = max(max_mtime, stat_result.st_mtime_ns)
+    return f"{count}:{total_size}:{max_mtime}"
+
+
+class VideoUploadResult(NamedTuple):
+    """Outcome of uploading one video's results"""
+    files: int
+    bytes: int
+    ok: bool
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD limit on concurrent uploads
+    
+    Used as a context manager around each transfer. Throttling responses halve the
+    limit (at most once per cooldown); every `increase_interval` seconds since both
+    the last change and the last throttled response raise it by one, up to `maximum`.
+    """
+    
+    def __init__(self, initial: int, maximum: int, increase_interval: float = CONCURRENCY_INCREASE_INTERVAL):
+        self.maximum = maximum
+        self.limit = max(1, min(initial, maximum))
+        self.increase_interval = increase_interval
+        self._in_flight = 0
+        self._last_change = time.monotonic()
+        self._last_throttle = float('-inf')
+        self._condition = threading.Condition()
+    
+    def __enter__(self):
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if (self.limit < self.maximum and now - self._last_change >= self.increase_interval
+                    and now - self._last_throttle >= self.increase_interval):
+                self.limit += 1
+                self._last_change = now
+            self._condition.notify_all()
+        return False
+    
+    def on_throttle(self) -> None:
+        """Halve the limit; a burst of throttled requests only counts once per cooldown"""
+        with self._condition:
+            now = time.monotonic()
+            # Every throttled response restarts the clean interval, even when the limit can't drop
+            self._last_throttle = now
+            if self.limit > 1 and now - self._last_change >= THROTTLE_COOLDOWN:
+                self.limit = max(1, self.limit // 2)
+                self._last_change = now
+                logger.warning(f"🐢 Azure throttling detected, upload concurrency reduced to {self.limit}")
+
 
 class AzureBatchUploader:
     """Upload processing results for any batch to Azure Blob Storage"""
     
-    def __init__(self, connection_string: str):
-        self.blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+    def __init__(self, connection_string: str, max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 max_file_concurrency: int = DEFAULT_MAX_FILE_CONCURRENCY, aggregate: bool = False,
+                 server_side_copy: bool = False, bundle_small_files: bool = False):
+        # Transfers actually in flight adapt between 1 and max_file_concurrency
+        self._limiter = AdaptiveConcurrencyLimiter(INITIAL_FILE_CONCURRENCY, max_file_concurrency)
+        
+        self.blob_service_client = BlobServiceClient.from_connection_string(
+            connection_string,
+            transport=_build_transport(max(MAX_CONNECTIONS, max_concurrency + max_file_concurrency)),
+            raw_response_hook=self._on_response
+        )
+        self.max_concurrency = max_concurrency
+        self.aggregate = aggregate
+        self.server_side_copy = server_side_copy
+        self.bundle_small_files = bundle_small_files
+        
         self.container = "videos"
         self.base_results_path = "ruijian-research/batch_results"
+        self.container_client = self.blob_service_client.get_container_client(self.container)
+        
+        # One file-level pool shared by every video; kept separate from the video-level
+        # pool so video workers waiting on their files can never starve it
+        self._file_executor = ThreadPoolExecutor(max_workers=max_file_concurrency)
+        
+        # Path relative to the results directory -> [mtime_ns, size, md5 hex], persisted
+        # in MD5_CACHE_FILE between runs whatever directory the script is run from
+        self._md5_cache: Dict[str, list] = {}
+        self._md5_cache_lock = threading.Lock()
+        self._md5_cache_path = None
+        self._md5_cache_root = ''
+        
+        # Threads hashing large files while other files upload; hashlib releases the GIL
+        # on large buffers, so this runs in parallel without forking the threaded process
+        self._hash_pool: Optional[ThreadPoolExecutor] = None
+        self._hash_slots = threading.BoundedSemaphore(HASH_PREFETCH_LIMIT)
+        self._md5_pending: Dict[str, Future] = {}
+        
+        # Per-file upload manifest (sqlite) so re-runs skip finished files without calling Azure
+        self._manifest: Optional[sqlite3.Connection] = None
+        self._manifest_lock = threading.Lock()
+        self._manifest_done: Dict[str, Tuple[int, str]] = {}
+        
+        # MD5 hex -> (blob name, size) of results already in Azure, for server-side copies
+        self._md5_index: Dict[str, Tuple[str, int]] = {}
+        
+        # Append-only list of fully uploaded videos (COMPLETED_FILE)
+        self._completed_path = None
+        self._completed_lock = threading.Lock()
+    
+    def _on_response(self, response) -> None:
+        """Pipeline hook: every throttled response (including ones the SDK will retry) slows uploads down"""
+        if response.http_response.status_code in THROTTLE_STATUS_CODES:
+            self._limiter.on_throttle()
     
     def upload_batch_results(self, batch_id: str, results_dir: str, limit: int = None, start_from: str = None) -> Dict:
         """Upload all processing results for a batch"""
@@ -43,58 +251,32 @@ class AzureBatchUploader:
         if not results_path.exists():
             raise FileNotFoundError(f"Results directory not found: {results_path}")
         
-        # Find all video result directories
-        video_dirs = []
-        for item in results_path.iterdir():
-            if item.is_dir() and item.name.startswith('00000500'):
-                video_dirs.append(item)
+        # Find all video result directories (sorted names; paths are joined where they're used)
+        video_ids = sorted(
+            entry.name for entry in os.scandir(results_dir)
+            if entry.is_dir() and entry.name.startswith('00000500')
+        )
         
-        video_dirs.sort()
+        # Videos a previous run finished, and whose files haven't changed since, need no Azure call
+        total_found = len(video_ids)
+        video_ids = self._skip_completed(batch_id, results_path, video_ids)
+        skipped_completed = total_found - len(video_ids)
         
         # Filter results if needed
         if start_from:
-            start_idx = 0
-            for i, video_dir in enumerate(video_dirs):
-                if start_from in video_dir.name:
-                    start_idx = i
-                    break
-            video_dirs = video_dirs[start_idx:]
+            # video_ids is sorted, so the first name >= start_from is found by bisection
+            video_ids = video_ids[bisect.bisect_left(video_ids, start_from):]
             logger.info(f"⏭️ Starting from video: {start_from}")
         
         if limit:
-            video_dirs = video_dirs[:limit]
+            video_ids = video_ids[:limit]
             logger.info(f"🔢 Limited to {limit} video results")
         
-        logger.info(f"🚀 Uploading {len(video_dirs)} video results for batch_{batch_id}")
+        logger.info(f"🚀 Uploading {len(video_ids)} video results for batch_{batch_id}")
         
         # Upload statistics
-        uploaded_count = 0
-        failed_count = 0
-        total_files = 0
-        total_size = 0
         start_time = time.time()
-        
-        for i, video_dir in enumerate(video_dirs):
-            video_id = video_dir.name
-            
-            try:
-                logger.info(f"☁️ [{i+1}/{len(video_dirs)}] Uploading {video_id}")
-                
-                # Upload all files in this video directory
-                files_uploaded, files_size = self._upload_video_results(batch_id, video_id, video_dir)
-                
-                if files_uploaded > 0:
-                    uploaded_count += 1
-                    total_files += files_uploaded
-                    total_size += files_size
-                    logger.info(f"✅ Uploaded {video_id} ({files_uploaded} files, {files_size:,} bytes)")
-                else:
-                    failed_count += 1
-                    logger.error(f"❌ Failed to upload {video_id}")
-                
-            except Exception as e:
-                failed_count += 1
-                logger.error(f"💥 Error uploading {video_id}: {e}")
+        uploaded_count, failed_count, total_files, total_size = self._upload_videos(batch_id, results_path, video_ids)
         
         # Summary statistics
         elapsed_time = time.time() - start_time
@@ -102,7 +284,8 @@ class AzureBatchUploader:
         
         stats = {
             'batch_id': batch_id,
-            'total_video_dirs': len(video_dirs),
+            'total_video_dirs': skipped_completed + len(video_ids),
+            'skipped_completed': skipped_completed,
             'uploaded_videos': uploaded_count,
             'failed_videos': failed_count,
             'success_rate': success_rate,
@@ -115,6 +298,7 @@ class AzureBatchUploader:
         
         logger.info(f"""
 🎯 Upload Summary for batch_{batch_id}:
+   ⏭️ Already uploaded (unchanged): {skipped_completed} videos
    ✅ Successfully uploaded: {uploaded_count} videos
    ❌ Failed: {failed_count} videos
    📊 Success rate: {success_rate:.1f}%
@@ -131,56 +315,482 @@ class AzureBatchUploader:
         
         return stats
     
-    def _upload_video_results(self, batch_id: str, video_id: str, video_dir: Path) -> Tuple[int, int]:
+    def _load_md5_cache(self, results_path: Path) -> None:
+        """Load the local MD5 cache sidecar for a results directory"""
+        self._md5_cache_path = results_path / MD5_CACHE_FILE
+        self._md5_cache_root = os.path.join(str(results_path), '')
+        try:
+            with open(self._md5_cache_path, 'r') as f:
+                self._md5_cache = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._md5_cache = {}
+    
+    def _save_md5_cache(self) -> None:
+        """Persist the local MD5 cache so later runs skip rehashing unchanged files"""
+        if self._md5_cache_path is None:
+            return
+        try:
+            with self._md5_cache_lock:
+                data = json.dumps(self._md5_cache)
+            self._md5_cache_path.write_text(data)
+        except OSError as e:
+            logger.warning(f"⚠️ Could not save MD5 cache {self._md5_cache_path}: {e}")
+    
+    def _md5_cache_key(self, local_path: str) -> str:
+        """Key a file in the MD5 cache by its path relative to the results directory"""
+        if self._md5_cache_root and local_path.startswith(self._md5_cache_root):
+            return local_path[len(self._md5_cache_root):]
+        return local_path
+    
+    def _local_md5(self, local_path: str, stat_result: os.stat_result) -> bytes:
+        """Return the file's MD5, reusing the cached digest if mtime and size are unchanged"""
+        key = self._md5_cache_key(local_path)
+        with self._md5_cache_lock:
+            cached = self._md5_cache.get(key)
+            pending = self._md5_pending.pop(local_path, None)
+        if cached and cached[0] == stat_result.st_mtime_ns and cached[1] == stat_result.st_size:
+            return bytes.fromhex(cached[2])
+        
+        digest = None
+        if pending is not None:
+            try:
+                digest = pending.result()
+            except Exception as e:
+                logger.warning(f"⚠️ Hash worker failed for {local_path}, hashing inline: {e}")
+        if digest is None:
+            digest = _md5_file(local_path)
+        with self._md5_cache_lock:
+            self._md5_cache[key] = [stat_result.st_mtime_ns, stat_result.st_size, digest.hex()]
+        return digest
+    
+    def _prefetch_md5(self, files: List[Tuple[str, str, os.stat_result]]) -> None:
+        """Start hashing large, uncached files in the hash pool so digests are ready when uploads need them"""
+        if self._hash_pool is None:
+            return
+        for local_path, _, stat_result in files:
+            if stat_result.st_size < HASH_OFFLOAD_THRESHOLD:
+                continue
+            with self._md5_cache_lock:
+                cached = self._md5_cache.get(self._md5_cache_key(local_path))
+                if local_path in self._md5_pending:
+                    continue
+            if cached and cached[0] == stat_result.st_mtime_ns and cached[1] == stat_result.st_size:
+                continue
+            # Queue full: leave the file to be hashed inline rather than stall this video
+            if not self._hash_slots.acquire(blocking=False):
+                return
+            future = self._hash_pool.submit(_md5_file, local_path)
+            future.add_done_callback(lambda _: self._hash_slots.release())
+            with self._md5_cache_lock:
+                self._md5_pending[local_path] = future
+    
+    def _completed_key(self, batch_id: str, video_id: str) -> str:
+        """COMPLETED_FILE key; per batch, and per upload mode since tar, bundle and per-file layouts differ"""
+        if self.aggregate:
+            mode = 'tar'
+        elif self.bundle_small_files:
+            mode = 'bundle'
+        else:
+            mode = 'files'
+        return f"{batch_id}/{video_id}/{mode}"
+    
+    def _skip_completed(self, batch_id: str, results_path: Path, video_ids: List[str]) -> List[str]:
+        """Drop videos recorded in COMPLETED_FILE whose files still match the recorded fingerprint"""
+        self._completed_path = results_path / COMPLETED_FILE
+        try:
+            lines = self._completed_path.read_text().splitlines()
+        except FileNotFoundError:
+            return video_ids
+        
+        # Later lines win, so a re-uploaded video's newest fingerprint is used
+        completed = {}
+        for line in lines:
+            key, _, fingerprint = line.partition('\t')
+            if fingerprint:
+                completed[key] = fingerprint
+        
+        results_dir = str(results_path)
+        remaining = []
+        for video_id in video_ids:
+            recorded = completed.get(self._completed_key(batch_id, video_id))
+            if recorded is not None:
+                video_dir = os.path.join(results_dir, video_id)
+                if recorded == _fingerprint(entry.stat() for entry, _ in _walk_files(video_dir)):
+                    continue
+            remaining.append(video_id)
+        
+        if len(remaining) < len(video_ids):
+            logger.info(f"⏭️ Skipping {len(video_ids) - len(remaining)} unchanged videos recorded in {COMPLETED_FILE}")
+        return remaining
+    
+    def _mark_completed(self, batch_id: str, video_id: str, fingerprint: str) -> None:
+        """Append a fully uploaded video to COMPLETED_FILE, fsynced so a crash can't lose it"""
+        if self._completed_path is None:
+            return
+        line = f"{self._completed_key(batch_id, video_id)}\t{fingerprint}\n".encode()
+        with self._completed_lock:
+            fd = os.open(str(self._completed_path), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+    
+    def _build_md5_index(self) -> None:
+        """Index every uploaded result blob by MD5 with a single listing"""
+        self._md5_index = {}
+        for blob in self.container_client.list_blobs(name_starts_with=self.base_results_path + '/', include=['metadata']):
+            md5_hex = (blob.metadata or {}).get('md5')
+            if not md5_hex and blob.content_settings.content_md5:
+                md5_hex = bytes(blob.content_settings.content_md5).hex()
+            if md5_hex:
+                self._md5_index.setdefault(md5_hex, (blob.name, blob.size))
+        
+        logger.info(f"📋 Indexed {len(self._md5_index)} existing result blobs by MD5")
+    
+    def _open_manifest(self, manifest_path: Path) -> None:
+        """Open (or create) the upload manifest and load the files it records as done"""
+        self._manifest = sqlite3.connect(str(manifest_path), check_same_thread=False)
+        self._manifest.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            "blob_path TEXT PRIMARY KEY, video_id TEXT, size INTEGER, md5 TEXT, uploaded_at TEXT)"
+        )
+        self._manifest.commit()
+        self._manifest_done = {
+            blob_path: (size, md5)
+            for blob_path, size, md5 in self._manifest.execute("SELECT blob_path, size, md5 FROM uploads")
+        }
+        logger.info(f"📒 Upload manifest {manifest_path.name}: {len(self._manifest_done)} files already recorded")
+    
+    def _close_manifest(self) -> None:
+        """Close the upload manifest"""
+        if self._manifest is not None:
+            with self._manifest_lock:
+                self._manifest.close()
+                self._manifest = None
+    
+    def _record_uploads(self, video_id: str, rows: List[Tuple[str, int, str]]) -> None:
+        """Record a video's uploaded (blob_path, size, md5) rows, committing once per video"""
+        if self._manifest is None or not rows:
+            return
+        uploaded_at = datetime.now().isoformat()
+        with self._manifest_lock:
+            self._manifest.executemany(
+                "INSERT OR REPLACE INTO uploads (blob_path, video_id, size, md5, uploaded_at) VALUES (?, ?, ?, ?, ?)",
+                [(blob_path, video_id, size, md5, uploaded_at) for blob_path, size, md5 in rows]
+            )
+            self._manifest.commit()
+    
+    def _upload_videos(self, batch_id: str, results_path: Path, video_ids: List[str]) -> Tuple[int, int, int, int]:
+        """Upload the named video result directories concurrently, returning (uploaded, failed, files, bytes)"""
+        self._load_md5_cache(results_path)
+        self._open_manifest(results_path / f"upload_report_batch_{batch_id}.db")
+        
+        if self.server_side_copy:
+            try:
+                self._build_md5_index()
+            except Exception as e:
+                logger.warning(f"⚠️ Could not index existing blobs, server-side copy disabled: {e}")
+                self._md5_index = {}
+        
+        if not self.aggregate:
+            self._hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='md5')
+        
+        results: List[VideoUploadResult] = []
+        results_dir = str(results_path)
+        
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = {
+                executor.submit(self._upload_video_results, batch_id, video_id, os.path.join(results_dir, video_id)): video_id
+                for video_id in video_ids
+            }
+            
+            # Each video reports its own totals; they're summed once at the end, so nothing is shared
+            for future in as_completed(futures):
+                video_id = futures[future]
+                progress = f"[{len(results) + 1}/{len(video_ids)}]"
+                
+                try:
+                    result = future.result()
+                    
+                    if result.ok:
+                        logger.debug("✅ %s Uploaded %s (%d files, %d bytes)", progress, video_id, result.files, result.bytes)
+                    else:
+                        logger.error(f"❌ {progress} Failed to upload {video_id} ({result.files} files uploaded)")
+                    
+                except Exception as e:
+                    result = VideoUploadResult(0, 0, False)
+                    logger.error(f"💥 {progress} Error uploading {video_id}: {e}")
+                
+                results.append(result)
+                
+                # Progress heartbeat instead of an INFO line per video
+                done = len(results)
+                if done % PROGRESS_LOG_INTERVAL == 0 or done == len(video_ids):
+                    logger.info("☁️ [%d/%d] videos processed", done, len(video_ids))
+        
+        uploaded_count = sum(1 for result in results if result.ok)
+        failed_count = len(results) - uploaded_count
+        total_files = sum(result.files for result in results)
+        total_size = sum(result.bytes for result in results)
+        
+        if self._hash_pool is not None:
+            self._hash_pool.shutdown()
+            self._hash_pool = None
+            self._md5_pending.clear()
+        
+        self._save_md5_cache()
+        self._close_manifest()
+        return uploaded_count, failed_count, total_files, total_size
+    
+    def _upload_video_results(self, batch_id: str, video_id: str, video_dir: str) -> VideoUploadResult:
         """Upload all result files for a single video"""
         upload_base = f"{self.base_results_path}/batch_{batch_id}/{video_id}"
         
+        if self.aggregate:
+            # Fingerprint before archiving, so files changed mid-upload are picked up next run
+            fingerprint = _fingerprint(entry.stat() for entry, _ in _walk_files(video_dir))
+            files_archived, archive_size = self._upload_video_archive(upload_base, video_dir)
+            self._mark_completed(batch_id, video_id, fingerprint)
+            return VideoUploadResult(files_archived, archive_size, True)
+        
         files_uploaded = 0
         total_size = 0
         
-        # Upload all files maintaining directory structure
-        for file_path in video_dir.rglob('*'):
-            if file_path.is_file():
-                relative_path = file_path.relative_to(video_dir)
-                blob_path = f"{upload_base}/{relative_path}"
-                
-                success, file_size = self._upload_file(file_path, blob_path)
-                if success:
-                    files_uploaded += 1
-                    total_size += file_size
+        files = [
+            (entry.path, f"{upload_base}/{relative_path}", entry.stat())
+            for entry, relative_path in _walk_files(video_dir)
+        ]
+        fingerprint = _fingerprint(stat_result for _, _, stat_result in files)
+        self._prefetch_md5(files)
+        
+        # Many small files: send them as blocks of one bundle blob instead of a PUT each.
+        # The bundle is rewritten as a whole, so it always holds all of the video's small files
+        bundled = []
+        if self.bundle_small_files:
+            small = [item for item in files if item[2].st_size < BUNDLE_MAX_FILE_SIZE]
+            if len(small) >= BUNDLE_MIN_FILES:
+                bundled = small
+                files = [item for item in files if item[2].st_size >= BUNDLE_MAX_FILE_SIZE]
+        
+        # Files the manifest already records with the same size and content need no Azure call
+        pending = []
+        for local_path, blob_path, stat_result in files:
+            if self._is_recorded(local_path, blob_path, stat_result):
+                files_uploaded += 1
+                total_size += stat_result.st_size
+            else:
+                pending.append((local_path, blob_path, stat_result))
+        
+        rows = []
+        
+        if bundled:
+            # Bundled files are recorded under the bundle blob ("_bundle.bin#relative/path"),
+            # never under their own blob paths, which don't exist in Azure
+            prefix_len = len(upload_base) + 1
+            bundle_base = f"{upload_base}/{BUNDLE_BLOB_NAME}#"
+            members = [
+                (local_path, bundle_base + blob_path[prefix_len:], stat_result)
+                for local_path, blob_path, stat_result in bundled
+            ]
+            if all(self._is_recorded(*member) for member in members):
+                files_uploaded += len(bundled)
+                total_size += sum(stat_result.st_size for _, _, stat_result in bundled)
+            else:
+                for local_path, member_path, stat_result in members:
+                    rows.append((member_path, stat_result.st_size, self._local_md5(local_path, stat_result).hex()))
+                bundled_size = self._upload_bundle(upload_base, bundled)
+                files_uploaded += len(bundled)
+                total_size += bundled_size
+        
+        if not pending:
+            self._record_uploads(video_id, rows)
+            self._mark_completed(batch_id, video_id, fingerprint)
+            return VideoUploadResult(files_uploaded, total_size, True)
+        
+        # One listing of what's already uploaded replaces a HEAD request per file
+        existing = {
+            blob.name: (blob.size, blob.content_settings.content_md5)
+            for blob in self.container_client.list_blobs(name_starts_with=upload_base + '/')
+        }
         
-        return files_uploaded, total_size
+        # Upload all files maintaining directory structure, in parallel on the shared file pool
+        results = self._file_executor.map(
+            lambda item: self._upload_file(item[0], item[1], existing, item[2]),
+            pending
+        )
+        
+        all_succeeded = True
+        for (local_path, blob_path, stat_result), (success, file_size) in zip(pending, results):
+            if success:
+                files_uploaded += 1
+                total_size += file_size
+                rows.append((blob_path, file_size, self._local_md5(local_path, stat_result).hex()))
+            else:
+                all_succeeded = False
+        
+        self._record_uploads(video_id, rows)
+        if all_succeeded:
+            self._mark_completed(batch_id, video_id, fingerprint)
+        return VideoUploadResult(files_uploaded, total_size, all_succeeded)
     
-    def _upload_file(self, local_path: Path, blob_path: str) -> Tuple[bool, int]:
-        """Upload a single file to Azure"""
-        try:
-            blob_client = self.blob_service_client.get_blob_client(
-                container=self.container,
-                blob=blob_path
-            )
+    def _is_recorded(self, local_path: str, blob_path: str, stat_result: os.stat_result) -> bool:
+        """True if the manifest records this file as uploaded with the same size and content"""
+        recorded = self._manifest_done.get(blob_path)
+        return (recorded is not None and recorded[0] == stat_result.st_size
+                and recorded[1] == self._local_md5(local_path, stat_result).hex())
+    
+    def _upload_bundle(self, upload_base: str, items: List[Tuple[str, str, os.stat_result]]) -> int:
+        """
+        Upload small files as the blocks of one bundle blob plus a JSON index sidecar
+        
+        Blocks are staged in parallel and committed once. The index maps each file's
+        relative path to its (offset, length) in the bundle, so single files can still
+        be fetched with a ranged read. Returns the bundle size in bytes.
+        """
+        bundle_client = self.container_client.get_blob_client(f"{upload_base}/{BUNDLE_BLOB_NAME}")
+        prefix_len = len(upload_base) + 1
+        
+        def stage(numbered_item):
+            block_number, (local_path, blob_path, _) = numbered_item
+            # Block IDs within a blob must all have the same length
+            block_id = base64.b64encode(f"{block_number:08d}".encode()).decode()
+            with open(local_path, 'rb') as f:
+                data = f.read()
+            with self._limiter:
+                bundle_client.stage_block(block_id, data)
+            return block_id, blob_path[prefix_len:], len(data)
+        
+        staged = list(self._file_executor.map(stage, enumerate(items)))
+        
+        index = {}
+        offset = 0
+        for _, relative_path, length in staged:
+            index[relative_path] = {'offset': offset, 'length': length}
+            offset += length
+        
+        bundle_client.commit_block_list([BlobBlock(block_id=block_id) for block_id, _, _ in staged])
+        self.container_client.get_blob_client(f"{upload_base}/{BUNDLE_INDEX_NAME}").upload_blob(
+            json.dumps({'bundle': BUNDLE_BLOB_NAME, 'files': index}, indent=2).encode(),
+            overwrite=True
+        )
+        
+        logger.debug("📦 Bundled %d small files into %s/%s (%d bytes)", len(staged), upload_base, BUNDLE_BLOB_NAME, offset)
+        return offset
+    
+    def _upload_video_archive(self, upload_base: str, video_dir: str) -> Tuple[int, int]:
+        """Upload all result files for a video as one uncompressed tar blob ({upload_base}.tar)"""
+        blob_client = self.container_client.get_blob_client(f"{upload_base}.tar")
+        files_archived = 0
+        
+        with tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE) as archive:
+            # Follow symlinked files like per-file mode does, rather than archiving dangling links
+            with tarfile.open(fileobj=archive, mode='w|', dereference=True) as tar:
+                for entry, relative_path in _walk_files(video_dir):
+                    tar.add(entry.path, arcname=relative_path)
+                    files_archived += 1
+            
+            archive_size = archive.tell()
+            
+            # Tar pads to 512-byte blocks, so size alone misses most edits; compare content MD5
+            archive.seek(0)
+            h = hashlib.md5()
+            while chunk := archive.read(1 << 20):
+                h.update(chunk)
+            archive_md5 = h.digest()
             
-            # Check if file already exists and is identical
+            # Skip if an identical archive is already there
             try:
-                blob_properties = blob_client.get_blob_properties()
-                local_size = local_path.stat().st_size
-                if local_size == blob_properties.size:
-                    logger.debug(f"⏭️ Skipping {blob_path} - already exists ({local_size:,} bytes)")
-                    return True, local_size
+                props = blob_client.get_blob_properties()
+                remote_md5 = props.content_settings.content_md5
+                if props.size == archive_size and remote_md5 and bytes(remote_md5) == archive_md5:
+                    logger.debug("⏭️ Skipping %s.tar - already exists (%d bytes)", upload_base, archive_size)
+                    return files_archived, archive_size
             except ResourceNotFoundError:
-                pass  # File doesn't exist, proceed with upload
+                pass  # Archive doesn't exist, proceed with upload
             
-            # Upload file
-            file_size = local_path.stat().st_size
-            with open(local_path, 'rb') as f:
-                blob_client.upload_blob(f, overwrite=True)
+            archive.seek(0)
+            with self._limiter:
+                blob_client.upload_blob(
+                    archive,
+                    length=archive_size,
+                    overwrite=True,
+                    max_concurrency=BLOB_MAX_CONCURRENCY,
+                    content_settings=ContentSettings(content_md5=archive_md5)
+                )
+        
+        logger.debug("✅ Uploaded %s.tar (%d files, %d bytes)", upload_base, files_archived, archive_size)
+        return files_archived, archive_size
+    
+    def _upload_file(self, local_path: str, blob_path: str,
+                     existing: Dict[str, Tuple[int, Optional[bytearray]]],
+                     stat_result: os.stat_result) -> Tuple[bool, int]:
+        """Upload a single file to Azure unless `existing` shows identical content already there"""
+        try:
+            file_size = stat_result.st_size
+            local_md5 = self._local_md5(local_path, stat_result)
+            
+            # Check if file already exists with identical content
+            remote = existing.get(blob_path)
+            if remote is not None:
+                remote_size, remote_md5 = remote
+                if file_size == remote_size and remote_md5 and bytes(remote_md5) == local_md5:
+                    logger.debug("⏭️ Skipping %s - already exists (%d bytes)", blob_path, file_size)
+                    return True, file_size
+            
+            # Hold a slot from the adaptive limiter for the network transfer only
+            with self._limiter:
+                self._send_file(local_path, blob_path, file_size, local_md5)
             
-            logger.debug(f"✅ Uploaded {blob_path} ({file_size:,} bytes)")
             return True, file_size
             
         except Exception as e:
             logger.error(f"❌ Failed to upload {local_path} → {blob_path}: {e}")
             return False, 0
     
+    def _send_file(self, local_path: str, blob_path: str, file_size: int, local_md5: bytes) -> None:
+        """Put a file's bytes in Azure, via server-side copy when identical content already exists"""
+        blob_client = self.container_client.get_blob_client(blob_path)
+        md5_hex = local_md5.hex()
+        
+        # Identical content already elsewhere in Azure: copy server-side instead of re-sending bytes
+        source = self._md5_index.get(md5_hex)
+        if source is not None and source[0] != blob_path and source[1] == file_size:
+            try:
+                source_url = self.container_client.get_blob_client(source[0]).url
+                copy = blob_client.start_copy_from_url(source_url, metadata={'md5': md5_hex})
+                # Same-account copies normally finish synchronously; anything else is
+                # aborted and uploaded normally rather than recorded as done
+                if copy.get('copy_status') == 'success':
+                    logger.debug("📋 Copied %s → %s (%d bytes)", source[0], blob_path, file_size)
+                    return
+                if copy.get('copy_status') == 'pending':
+                    blob_client.abort_copy(copy['copy_id'])
+                logger.debug("Server-side copy of %s not completed (%s), uploading instead",
+                             blob_path, copy.get('copy_status'))
+            except Exception as e:
+                logger.debug("Server-side copy failed for %s, uploading instead: %s", blob_path, e)
+        
+        # Upload file, recording its MD5 so later runs can compare content.
+        # Small files go up as one in-memory buffer in a single PUT; large ones
+        # stream from the file handle, which the SDK reads one block at a time
+        upload_kwargs = dict(
+            length=file_size,
+            overwrite=True,
+            content_settings=ContentSettings(content_md5=local_md5),
+            metadata={'md5': md5_hex}
+        )
+        with open(local_path, 'rb') as f:
+            if file_size < STREAM_THRESHOLD:
+                blob_client.upload_blob(f.read(), **upload_kwargs)
+            else:
+                blob_client.upload_blob(f, max_concurrency=BLOB_MAX_CONCURRENCY, **upload_kwargs)
+        
+        if self.server_side_copy:
+            self._md5_index.setdefault(md5_hex, (blob_path, file_size))
+        
+        logger.debug("✅ Uploaded %s (%d bytes)", blob_path, file_size)
+    
     def check_video_completeness(self, results_dir: str) -> Dict:
         """Check completeness of video processing results"""
         results_path = Path(results_dir)
@@ -197,14 +807,21 @@ class AzureBatchUploader:
             'missing_videos': []
         }
         
-        for video_dir in results_path.glob('00000500*'):
-            if video_dir.is_dir():
-                video_id = video_dir.name
+        with os.scandir(results_path) as it:
+            for entry in it:
+                if not (entry.name.startswith('00000500') and entry.is_dir()):
+                    continue
+                
+                video_id = entry.name
                 missing_files = []
                 
                 for required_file in required_files:
-                    file_path = video_dir / required_file
-                    if not file_path.exists() or file_path.stat().st_size < 1000:
+                    # One stat answers both "exists?" and "big enough?"
+                    try:
+                        too_small = os.stat(os.path.join(entry.path, required_file)).st_size < 1000
+                    except FileNotFoundError:
+                        too_small = True
+                    if too_small:
                         missing_files.append(required_file)
                 
                 if not missing_files:
@@ -230,6 +847,9 @@ class AzureBatchUploader:
         completeness_stats = self.check_video_completeness(results_dir)
         complete_videos = completeness_stats['complete_videos']
         
+        complete_videos = self._skip_completed(batch_id, Path(results_dir), complete_videos)
+        skipped_completed = len(completeness_stats['complete_videos']) - len(complete_videos)
+        
         if limit:
             complete_videos = complete_videos[:limit]
         
@@ -237,32 +857,10 @@ class AzureBatchUploader:
         
         # Upload only complete videos
         results_path = Path(results_dir)
-        uploaded_count = 0
-        failed_count = 0
-        total_files = 0
-        total_size = 0
         start_time = time.time()
-        
-        for i, video_id in enumerate(complete_videos):
-            video_dir = results_path / video_id
-            
-            try:
-                logger.info(f"☁️ [{i+1}/{len(complete_videos)}] Uploading {video_id}")
-                
-                files_uploaded, files_size = self._upload_video_results(batch_id, video_id, video_dir)
-                
-                if files_uploaded > 0:
-                    uploaded_count += 1
-                    total_files += files_uploaded
-                    total_size += files_size
-                    logger.info(f"✅ Uploaded {video_id} ({files_uploaded} files)")
-                else:
-                    failed_count += 1
-                    logger.error(f"❌ Failed to upload {video_id}")
-                
-            except Exception as e:
-                failed_count += 1
-                logger.error(f"💥 Error uploading {video_id}: {e}")
+        uploaded_count, failed_count, total_files, total_size = self._upload_videos(
+            batch_id, results_path, complete_videos
+        )
         
         # Statistics
         elapsed_time = time.time() - start_time
@@ -272,6 +870,7 @@ class AzureBatchUploader:
             'batch_id': batch_id,
             'complete_videos_found': len(completeness_stats['complete_videos']),
             'incomplete_videos_skipped': len(completeness_stats['incomplete_videos']),
+            'skipped_completed': skipped_completed,
             'uploaded_videos': uploaded_count,
             'failed_videos': failed_count,
             'success_rate': success_rate,
@@ -293,9 +892,14 @@ def main():
     
     # Upload control
     parser.add_argument("--limit", type=int, help="Limit number of videos to upload")
-    parser.add_argument("--start-from", help="Video ID to start uploading from")
+    parser.add_argument("--start-from", help="Video ID (or ID prefix) to start uploading from, in sorted order")
     parser.add_argument("--complete-only", action="store_true", help="Upload only videos with complete results")
     parser.add_argument("--check-only", action="store_true", help="Only check completeness, don't upload")
+    parser.add_argument("--max-concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY, help="Number of videos to upload in parallel")
+    parser.add_argument("--max-file-concurrency", type=int, default=DEFAULT_MAX_FILE_CONCURRENCY, help=f"Upper bound on files uploaded in parallel across all videos; transfers start at {INITIAL_FILE_CONCURRENCY}, gain 1 per throttle-free minute and halve on throttling")
+    parser.add_argument("--aggregate", action="store_true", help="Upload each video's results as a single <video_id>.tar blob")
+    parser.add_argument("--server-copy", action="store_true", help="Copy files whose content already exists in Azure server-side instead of uploading")
+    parser.add_argument("--bundle-small", action="store_true", help="Pack each video's small files into one block blob with a JSON offset index")
     
     # Connection
     parser.add_argument("--connection-string", help="Azure storage connection string (or use .env)")
@@ -307,18 +911,22 @@ def main():
     if not connection_string:
         env_file = Path("/root/autodl-tmp/azure_sync/credentials/.env")
         if env_file.exists():
-            with open(env_file, 'r') as f:
-                for line in f:
-                    if line.strip() and line.startswith('AZURE_STORAGE_CONNECTION_STRING'):
-                        connection_string = line.split('=', 1)[1].strip().strip('"').strip("'")
-                        break
+            match = _CONN_RE.search(env_file.read_text())
+            connection_string = match.group(1).strip() if match else None
     
     if not connection_string:
         logger.error("❌ Azure connection string not found. Use --connection-string or set up .env file")
         sys.exit(1)
     
     try:
-        uploader = AzureBatchUploader(connection_string)
+        uploader = AzureBatchUploader(
+            connection_string,
+            max_concurrency=args.max_concurrency,
+            max_file_concurrency=args.max_file_concurrency,
+            aggregate=args.aggregate,
+            server_side_copy=args.server_copy,
+            bundle_small_files=args.bundle_small
+        )
         
         # Check completeness only
         if args.check_only: